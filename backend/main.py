@@ -3,6 +3,7 @@ import json
 import csv
 import io
 import os
+from dataclasses import asdict
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -36,6 +37,33 @@ async def health_check():
     return {"status": "ok", "message": "Web Crawler API is running"}
 
 
+async def _crawl_url(url: str, search_query: str, events: asyncio.Queue) -> None:
+    """
+    Runs the crawl flow for one URL and puts its SSE events on `events`,
+    followed by None when the URL is done.
+    """
+    try:
+        await events.put(f"data: {json.dumps({'type': 'status', 'message': f'Checking URL: {url}'})}\n\n")
+        
+        # Check Relevance & Extract
+        try:
+            # Companies are streamed to the client as soon as they are extracted
+            found = 0
+            async for company in process_url_flow(url, search_query):
+                found += 1
+                last_search_results.append(company)
+                await events.put(f"data: {json.dumps({'type': 'company', 'data': asdict(company)})}\n\n")
+            
+            if found:
+                await events.put(f"data: {json.dumps({'type': 'status', 'message': f'Found {found} companies on {url}'})}\n\n")
+            else:
+                await events.put(f"data: {json.dumps({'type': 'status', 'message': f'Skipped or no data: {url}'})}\n\n")
+
+        except Exception as e:
+            await events.put(f"data: {json.dumps({'type': 'error', 'message': f'Error crawling {url}: {str(e)}'})}\n\n")
+    finally:
+        await events.put(None)
+
 @app.post("/search")
 async def search_endpoint(request: SearchRequest):
     """
@@ -65,29 +93,27 @@ async def search_endpoint(request: SearchRequest):
         yield f"data: {json.dumps({'type': 'status', 'message': f'Found {len(search_results)} candidates. filtering with LLM...'})}\n\n"
         
         # Filter with LLM
-        from services.llm_filter import filter_search_results
-        urls = await asyncio.to_thread(filter_search_results, search_results, search_query)
+        from services.llm_filter import filter_search_results_async
+        urls = await filter_search_results_async(search_results, search_query)
         
         yield f"data: {json.dumps({'type': 'status', 'message': f'LLM selected {len(urls)} relevant URLs. Starting crawl...'})}\n\n"
         
-        # 2. Process each URL
-        for url in urls:
-            yield f"data: {json.dumps({'type': 'status', 'message': f'Checking URL: {url}'})}\n\n"
-            
-            # Check Relevance & Extract
-            try:
-                companies = await asyncio.to_thread(process_url_flow, url, search_query)
-                
-                if companies:
-                     yield f"data: {json.dumps({'type': 'status', 'message': f'Found {len(companies)} companies on {url}'})}\n\n"
-                     for company in companies:
-                         last_search_results.append(company)
-                         yield f"data: {json.dumps({'type': 'company', 'data': company.dict()})}\n\n"
-                else:
-                    yield f"data: {json.dumps({'type': 'status', 'message': f'Skipped or no data: {url}'})}\n\n"
-
-            except Exception as e:
-                yield f"data: {json.dumps({'type': 'error', 'message': f'Error crawling {url}: {str(e)}'})}\n\n"
+        # 2. Process the URLs concurrently; their events are interleaved as they arrive.
+        # LLM calls are bounded by the shared LLM semaphore/rate limiter, crawls by the crawl semaphore
+        events: asyncio.Queue = asyncio.Queue()
+        tasks = [asyncio.create_task(_crawl_url(url, search_query, events)) for url in urls]
+        try:
+            running = len(tasks)
+            while running:
+                event = await events.get()
+                if event is None: # One URL finished
+                    running -= 1
+                    continue
+                yield event
+        finally:
+            # Client disconnected - stop the crawls that are still running
+            for task in tasks:
+                task.cancel()
         
         yield f"data: {json.dumps({'type': 'status', 'message': f'✅ Crawling completed! Found {len(last_search_results)} companies total.'})}\n\n"
         yield f"data: {json.dumps({'type': 'done'})}\n\n"
@@ -100,7 +126,7 @@ def download_results(format: str):
     Download the last search results as CSV or JSON.
     """
     if format == "json":
-        data = json.dumps([c.dict() for c in last_search_results], indent=2)
+        data = json.dumps([asdict(c) for c in last_search_results], indent=2)
         return StreamingResponse(io.StringIO(data), media_type="application/json", headers={"Content-Disposition": "attachment; filename=companies.json"})
     
     elif format == "csv":
@@ -124,11 +150,10 @@ async def enrich_endpoint(request: EnrichRequest):
     async def event_generator():
         global last_search_results
         
-        # Convert dicts to Company objects
         from services.enrichment import deduplicate_by_name, enrich_company_details
         from services.searxng import search_google
         
-        companies = [Company(**c) for c in request.companies]
+        companies = request.companies
         
         yield f"data: {json.dumps({'type': 'status', 'message': f'Starting enrichment for {len(companies)} companies...'})}\\n\\n"
         
@@ -166,7 +191,7 @@ async def enrich_endpoint(request: EnrichRequest):
             company.description = enriched_data.get("description") or company.description
             
             enriched_companies.append(company)
-            yield f"data: {json.dumps({'type': 'company', 'data': company.dict()})}\\n\\n"
+            yield f"data: {json.dumps({'type': 'company', 'data': asdict(company)})}\\n\\n"
         
         # Update global results
         last_search_results = enriched_companies
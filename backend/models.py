@@ -1,12 +1,17 @@
-from pydantic import BaseModel
+from dataclasses import dataclass
 from typing import List, Optional
 
-class SearchRequest(BaseModel):
+# Plain slotted dataclasses: FastAPI still validates them at the API boundary,
+# but instances created internally (hundreds of Company objects per search) skip validation.
+
+@dataclass(slots=True)
+class SearchRequest:
     query: str
     limit: int = 10
     country: Optional[str] = None  # Optional country filter for more targeted searches
 
-class Company(BaseModel):
+@dataclass(slots=True, kw_only=True)
+class Company:
     name: str
     website: Optional[str] = None
     description: Optional[str] = None
@@ -15,16 +20,19 @@ class Company(BaseModel):
     address: Optional[str] = None
     source_url: str
 
-class CrawlStatus(BaseModel):
+@dataclass(slots=True)
+class CrawlStatus:
     url: str
     status: str  # "crawling", "skipped", "completed", "failed"
     companies_found: int = 0
     message: Optional[str] = None
 
-class SearchResponse(BaseModel):
+@dataclass(slots=True)
+class SearchResponse:
     results: List[Company]
     total_companies: int
 
-class EnrichRequest(BaseModel):
-    companies: List[dict]  # List of company dicts from frontend
+@dataclass(slots=True)
+class EnrichRequest:
+    companies: List[Company]  # Companies as returned by /search
     country: Optional[str] = None  # Optional country for more targeted enrichment
@@ -1,11 +1,16 @@
+import asyncio
 import requests
 import json
 import time
-from typing import List, Dict, Any, Optional
+from typing import AsyncIterator, List, Dict, Any, Optional
 from models import Company
 
 CRAWL4AI_URL = "https://crawle.up.railway.app/crawl"
 
+# Cap on concurrent page loads sent to Crawl4AI (each one drives a headless browser)
+CRAWL_CONCURRENCY = 5
+crawl_semaphore = asyncio.Semaphore(CRAWL_CONCURRENCY)
+
 def crawl_page_raw(url: str, js_code: List[str] = None) -> Dict[str, Any]:
     """
     Helper to fetch raw content from Crawl4AI without LLM extraction.
@@ -53,16 +58,16 @@ def crawl_page_raw(url: str, js_code: List[str] = None) -> Dict[str, Any]:
         print(f"Crawl exception for {url}: {e}")
         return {}
 
-from services.llm_extractor import extract_data_with_llm
+from services.llm_extractor import extract_data_with_llm_async
 
-def process_url_flow(start_url: str, query: str) -> List[Company]:
+async def process_url_flow(start_url: str, query: str) -> AsyncIterator[Company]:
     """
     Orchestrates the crawl flow for a single URL using LLM Extraction & Pagination:
     1. Fetch Raw Content (Page 1)
     2. Extract Data & Next Page using LLM
     3. Loop until no next page or limit reached (3 pages)
+    Yields companies as soon as the LLM has extracted them.
     """
-    companies: List[Company] = []
     current_url = start_url
     pages_crawled = 0
     visited_urls = set()
@@ -87,7 +92,8 @@ def process_url_flow(start_url: str, query: str) -> List[Company]:
              print(f"Crawling page {pages_crawled + 1}: {current_url}")
         
         # Execute crawl with any pending JS (e.g. click next)
-        page_data = crawl_page_raw(current_url, js_code=next_page_js_code)
+        async with crawl_semaphore:
+            page_data = await asyncio.to_thread(crawl_page_raw, current_url, next_page_js_code)
         
         # Reset JS code after use
         next_page_js_code = []
@@ -106,39 +112,47 @@ def process_url_flow(start_url: str, query: str) -> List[Company]:
             content_to_analyze = markdown_data
             
         if not content_to_analyze or len(content_to_analyze) < 100:
-            # Fallback to HTML
-            content_to_analyze = page_data.get("html", "")
+            # Fallback to HTML (the extractor uses the cleaned page HTML when no Markdown is given)
+            print("Markdown missing or too short, falling back to cleaned HTML")
+            content_to_analyze = ""
             
         print(f"Analyzing content length: {len(content_to_analyze)}")
         
-        # LLM Extraction
+        # LLM Extraction (streamed: companies arrive on the queue while the LLM is still answering)
         # Pass Markdown for content, HTML for pagination
         html_content = page_data.get("html", "")
-        extraction_result = extract_data_with_llm(content_to_analyze, html_content, query)
+        company_queue: asyncio.Queue = asyncio.Queue()
+        extraction_task = asyncio.create_task(
+            extract_data_with_llm_async(content_to_analyze, html_content, query, company_queue=company_queue)
+        )
         
-        new_companies_data = extraction_result.get("companies", [])
+        try:
+            while (c := await company_queue.get()) is not None:
+                # Basic validation/cleanup
+                if c.get("name"):
+                    yield Company(
+                        name=c.get("name", "Unknown"),
+                        website=c.get("website"),
+                        description=c.get("description"),
+                        email=c.get("email"),
+                        phone=c.get("phone"),
+                        address=c.get("address"),
+                        source_url=current_url
+                    )
+            extraction_result = await extraction_task
+        finally:
+            # Consumer went away (e.g. client disconnected) - don't leave the LLM call running
+            if not extraction_task.done():
+                extraction_task.cancel()
         
         # Check for Pagination Methods
         next_page_url = extraction_result.get("next_page_url")
         pagination_selector = extraction_result.get("pagination_selector")
         
-        print(f"EXTRACTOR: Found {len(new_companies_data)} companies.")
+        print(f"EXTRACTOR: Found {len(extraction_result.get('companies', []))} companies.")
         print(f"   Next URL: {next_page_url}")
         print(f"   Pagination Selector: {pagination_selector}")
         
-        for c in new_companies_data:
-            # Basic validation/cleanup
-            if c.get("name"):
-                 companies.append(Company(
-                    name=c.get("name", "Unknown"),
-                    website=c.get("website"),
-                    description=c.get("description"),
-                    email=c.get("email"),
-                    phone=c.get("phone"),
-                    address=c.get("address"),
-                    source_url=current_url
-                ))
-        
         # Pagination Logic Priority
         # 1. URL change is most reliable
         if next_page_url and next_page_url != current_url and next_page_url.startswith("http"):
@@ -161,5 +175,3 @@ def process_url_flow(start_url: str, query: str) -> List[Company]:
             current_url = None # Stop loop
             
         pages_crawled += 1
-            
-    return companies
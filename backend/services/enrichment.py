@@ -1,8 +1,7 @@
-import os
 from typing import List, Dict, Any
 from models import Company
 from services.searxng import search_google
-from openai import OpenAI
+from services.openai_client import get_client, create_chat_completion_sync
 import json
 
 def deduplicate_by_name(companies: List[Company]) -> List[Company]:
@@ -27,13 +26,11 @@ def enrich_company_details(company_name: str, search_snippets: List[str]) -> Dic
     Use LLM to extract and enrich contact details from search result snippets.
     Returns dict with enriched fields: email, phone, address, website, description
     """
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
+    client = get_client()
+    if not client:
         print(f"Warning: No OpenAI API Key. Skipping enrichment for {company_name}")
         return {}
     
-    client = OpenAI(api_key=api_key)
-    
     # Combine snippets into context
     context = "\n\n".join(search_snippets[:20])  # Limit to avoid token overflow
     
@@ -67,7 +64,8 @@ Search Results Context:
 Extract and return the contact details in JSON format."""
     
     try:
-        response = client.chat.completions.create(
+        response = create_chat_completion_sync(
+            client,
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": system_prompt},
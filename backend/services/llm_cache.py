@@ -0,0 +1,46 @@
+import hashlib
+import os
+from typing import Any, Optional
+
+# Try to import diskcache; without it every call goes to the API
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+LLM_CACHE_DIR = os.environ.get("LLM_CACHE_DIR", "/tmp/llm_cache")
+LLM_CACHE_SIZE_LIMIT = int(2e9) # bytes, oldest stored entries are evicted first
+
+_cache = None
+if diskcache:
+    try:
+        _cache = diskcache.Cache(LLM_CACHE_DIR, size_limit=LLM_CACHE_SIZE_LIMIT)
+    except Exception as e:
+        print(f"Warning: Could not open LLM cache at {LLM_CACHE_DIR} ({e}). Caching disabled.")
+
+def cache_key(model: str, system_prompt: str, user_prompt: str) -> str:
+    """
+    Content address of an LLM request: identical prompts to the same model share a key.
+    """
+    return hashlib.sha256("\0".join([model, system_prompt, user_prompt]).encode()).hexdigest()
+
+# diskcache calls are small local SQLite reads/writes; the async paths make them directly on the
+# event loop (like the rest of the per-request bookkeeping) rather than paying for a thread hop.
+# The cache is an optimisation only: any error is logged and treated as a miss / no-op.
+
+def get_cached(key: str) -> Optional[Any]:
+    if _cache is None:
+        return None
+    try:
+        return _cache.get(key)
+    except Exception as e:
+        print(f"Warning: LLM cache read failed ({e}), calling the API instead.")
+        return None
+
+def set_cached(key: str, value: Any) -> None:
+    if _cache is None:
+        return
+    try:
+        _cache[key] = value
+    except Exception as e:
+        print(f"Warning: LLM cache write failed ({e}), result not cached.")
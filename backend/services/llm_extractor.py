@@ -1,85 +1,169 @@
-from openai import OpenAI
-import os
-import json
+import asyncio
+import logging
+import re
 from typing import List, Dict, Any, Optional
 
-# Try to import BeautifulSoup for cleaning
+import orjson
+
+from services.openai_client import get_client, get_async_client, create_chat_completion, create_chat_completion_sync, stream_chat_completion
+from services.llm_cache import cache_key, get_cached, set_cached
+from services.tokens import count_prompt_tokens, count_tokens, pack_texts
+
+logger = logging.getLogger(__name__)
+
+# Try to import lxml for cleaning
 try:
-    from bs4 import BeautifulSoup
+    import lxml.html
+    from lxml import etree
+    # Compiled once; returns all interactive elements in document order in a single C-level pass
+    _INTERACTIVE_XPATH = etree.XPath("//a|//button|//input")
 except ImportError:
-    BeautifulSoup = None
+    lxml = None
+
+# Attributes that help the LLM identify pagination controls
+_INTERACTIVE_ATTRS = ("href", "id", "class", "aria-label", "title", "name", "value", "type")
+
+def _build_tree(html_content: str):
+    """
+    Parses HTML into an lxml tree. Returns None for empty/unparseable documents
+    (or when lxml is not installed).
+    """
+    if not lxml or not html_content:
+        return None
+    try:
+        try:
+            return lxml.html.fromstring(html_content)
+        except ValueError:
+            # lxml refuses str input with an XML encoding declaration (XHTML pages); parse the bytes instead
+            return lxml.html.fromstring(html_content.encode("utf-8"))
+    except (etree.ParserError, ValueError):
+        return None
+
+# Attributes that carry meaning for the LLM; the rest (styles, event handlers, tracking) is noise
+_PRESERVED_ATTRS = frozenset({"href", "src", "alt", "title", "id", "class", "aria-label", "name", "value", "type"})
+# Attributes that make an element meaningful even without content
+_MEANINGFUL_ATTRS = frozenset({"href", "src", "value", "alt", "title", "aria-label", "id"})
+# Tags that are meaningful even when empty (dropping empty table cells would shift columns)
+_KEEP_EMPTY_TAGS = frozenset({"br", "img", "input", "hr", "td", "th", "html", "body"})
+# Generic containers that carry no meaning of their own and can be collapsed into their only child
+_WRAPPER_TAGS = frozenset({"div", "span", "section", "article", "main", "aside", "font", "center"})
 
-def clean_content(html_content: str) -> str:
+def _compress_tree(tree) -> None:
     """
-    Cleans HTML content by removing boilerplate tags (nav, header, footer, scripts).
-    Returns text content.
+    Lossless structural compression of the tree (in place):
+    strips non-semantic attributes, drops empty tags and collapses
+    attribute-less wrappers that only hold a single child.
     """
-    if not BeautifulSoup:
-        return html_content # Fallback
+    elements = [el for el in tree.iter() if isinstance(el.tag, str)] # Skip comments/PIs
+
+    # 1. Attribute cleansing
+    for el in elements:
+        for k in list(el.attrib):
+            if k not in _PRESERVED_ATTRS and not k.startswith("data-"):
+                del el.attrib[k]
+
+    # 2. Drop empty tags, bottom-up so parents left empty are dropped too
+    for el in reversed(elements):
+        if el is tree or el.tag in _KEEP_EMPTY_TAGS:
+            continue
+        # Only truly empty tags: whitespace-only ones separate words ("Acme<span> </span>Corp"),
+        # and links/images/inputs carry their meaning in attributes (<a href="/page/2"></a>)
+        if not len(el) and not el.text and not _MEANINGFUL_ATTRS.intersection(el.attrib):
+            el.drop_tree() # Keeps the tail text
+
+    # 3. Collapse single-nested wrappers (<div><div><p>..</p></div></div> -> <p>..</p>)
+    for el in elements:
+        parent = el.getparent()
+        if parent is None or el.tag not in _WRAPPER_TAGS or el.attrib or len(el) != 1:
+            continue
+        if el.text: # Also whitespace-only text: it separates words ("Acme<span> <b>Corp</b></span>")
+            continue
+        child = el[0]
+        child.tail = (child.tail or "") + (el.tail or "")
+        parent.replace(el, child)
 
-    soup = BeautifulSoup(html_content, "lxml")
+def clean_content(tree) -> str:
+    """
+    Cleans a parsed HTML tree by removing boilerplate tags (nav, header, footer, scripts).
+    Returns the cleaned HTML of the body. Mutates the tree.
+    """
+    if tree is None:
+        return ""
     
-    # Remove distracting elements
-    for tag in soup(["script", "style", "nav", "header", "footer", "iframe", "svg", "noscript", "meta"]):
-        tag.decompose()
+    # Remove distracting elements (keep their tail text, it belongs to the parent)
+    etree.strip_elements(tree, "script", "style", "nav", "header", "footer", "iframe", "svg", "noscript", "meta", with_tail=False)
+    _compress_tree(tree)
         
-    # Get text, or return cleaned HTML if we want structure? 
-    # LLMs handle HTML structure well for tables. Let's return cleaned HTML string mainly for structure.
-    # But to save tokens, let's try to get a structured text representation or just the body.
+    # LLMs handle HTML structure well for tables. Return cleaned HTML string mainly for structure.
+    body = tree.find(".//body")
+    if body is not None:
+        return lxml.html.tostring(body, encoding="unicode")[:15000] # Limit to ~15k chars to avoid token limits (approx 3-4k tokens)
     
-    body = soup.find("body")
-    if body:
-        return str(body)[:15000] # Limit to ~15k chars to avoid token limits (approx 3-4k tokens)
-    
-    return str(soup)[:15000]
+    return lxml.html.tostring(tree, encoding="unicode")[:15000]
 
-def extract_interactive_elements(html_content: str) -> str:
+def extract_interactive_elements(tree) -> str:
     """
     Extracts interactive elements (a, button, input) with their attributes to help LLM find pagination.
     """
-    if not BeautifulSoup or not html_content:
+    if tree is None:
         return ""
-        
-    soup = BeautifulSoup(html_content, "lxml")
-    elements = []
+    parts = []
     
-    # Find all potentially interactive elements
-    for tag in soup.find_all(["a", "button", "input"]):
+    # Find all potentially interactive elements (first 500 or so to save context)
+    for el in _INTERACTIVE_XPATH(tree)[:500]:
         # Get key attributes
-        attrs = []
-        if tag.name == "a" and tag.get("href"):
-            attrs.append(f'href="{tag.get("href")}"')
-        
-        for attr in ["id", "class", "aria-label", "title", "name", "value", "type"]:
-             val = tag.get(attr)
-             if val:
-                 if isinstance(val, list): val = " ".join(val)
-                 attrs.append(f'{attr}="{val}"')
+        attr_str = " ".join([f'{k}="{v}"' for k in _INTERACTIVE_ATTRS if (v := el.get(k))])
+        text = el.text_content().strip()[:50] # Limit text length
+        parts.append(f'<{el.tag} {attr_str}>{text}</{el.tag}>')
         
-        text = tag.get_text(strip=True)[:50] # Limit text length
-        attr_str = " ".join(attrs)
-        
-        elements.append(f'<{tag.name} {attr_str}>{text}</{tag.name}>')
-        
-    return "\n".join(elements[:500]) # Limit to first 500 elements or so to save context
+    return "\n".join(parts)
 
-def extract_data_with_llm(content_markdown: str, html_content: str, query: str) -> Dict[str, Any]:
-    """
-    Extracts company data and next page URL/Selector using LLM.
-    Uses Markdown for content and HTML snippets for pagination.
-    """
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
-        print("Warning: No OpenAI API Key. Returning empty extraction.")
-        return {"companies": [], "next_page_url": None, "pagination_selector": None}
+EXTRACTION_MODEL = "gpt-4o-mini"
 
-    client = OpenAI(api_key=api_key)
-    
-    # 1. Prepare Content (Markdown for Companies)
-    # 2. Prepare Interactive Elements (HTML for Pagination)
-    interactive_html = extract_interactive_elements(html_content)
-    
-    system_prompt = """You are a data extraction bot. Your job is to find and extract INDIVIDUAL COMPANIES from the webpage content.
+_NULLABLE_STRING = {"type": ["string", "null"]}
+
+# Structured Outputs schema: the model is guaranteed to answer with parseable JSON of this shape
+# (strict mode requires every property to be listed in "required"; optional values are nullable)
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "companies": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "website": _NULLABLE_STRING,
+                    "email": _NULLABLE_STRING,
+                    "phone": _NULLABLE_STRING,
+                    "address": _NULLABLE_STRING,
+                    "description": _NULLABLE_STRING,
+                },
+                "required": ["name", "website", "email", "phone", "address", "description"],
+                "additionalProperties": False,
+            },
+        },
+        "next_page_url": _NULLABLE_STRING,
+        "pagination_selector": _NULLABLE_STRING,
+    },
+    "required": ["companies", "next_page_url", "pagination_selector"],
+    "additionalProperties": False,
+}
+
+_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "extraction", "schema": EXTRACTION_SCHEMA, "strict": True},
+}
+
+# Token budget per request (keeps cost/latency bounded, well below the model's context), minus room for the JSON answer
+MAX_INPUT_TOKENS = 14000
+RESPONSE_TOKEN_RESERVE = 2000
+# Share of the input budget for page content vs interactive elements
+CONTENT_SHARE = 0.6
+INTERACTIVE_SHARE = 0.4
+
+# Kept byte-identical across calls and sent first, so OpenAI's automatic prompt caching applies
+SYSTEM_PROMPT = """You are a data extraction bot. Your job is to find and extract INDIVIDUAL COMPANIES from the webpage content.
 
 IMPORTANT: You are looking for COMPANIES LISTED ON THE PAGE, sometimes the website itself is not a company.
 
@@ -167,39 +251,258 @@ Return JSON:
 
 REMEMBER: Extract INDIVIDUAL COMPANIES from the content, not the website itself.
 """
-    
-    # Debug: Print first 500 chars of content to see what LLM is receiving
-    print(f"\n=== LLM EXTRACTOR DEBUG ===")
-    print(f"Query: {query}")
-    print(f"Content length: {len(content_markdown)} chars")
-    print(f"Content preview (first 500 chars):\n{content_markdown[:500]}")
-    print(f"===========================\n")
-    
-    user_prompt = f"""User Query: {query}
+
+_USER_PROMPT_TEMPLATE = """User Query: {query}
     
     --- WEBPAGE CONTENT (Extract companies from this) ---
-    {content_markdown[:15000]}
+    {content}
     
     --- INTERACTIVE ELEMENTS (For pagination) ---
-    {interactive_html[:10000]}
+    {interactive}
     
     EXTRACT ALL COMPANIES YOU FIND. Look for repeated patterns of business names with location/contact info.
     """
 
+# Page sections the LLM sometimes mistakes for companies
+_NON_COMPANY_NAMES = frozenset({"home", "about us", "contact", "contact us", "login"})
+
+def _is_company(company: Dict[str, Any]) -> bool:
+    name = company.get("name")
+    return isinstance(name, str) and name.strip().casefold() not in _NON_COMPANY_NAMES
+
+def _drop_non_companies(result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Post-processing: removes navigation labels etc. from the extracted companies.
+    """
+    companies = result.get("companies")
+    if isinstance(companies, list):
+        result["companies"] = [c for c in companies if isinstance(c, dict) and _is_company(c)]
+    return result
+
+def _empty_result() -> Dict[str, Any]:
+    return {"companies": [], "next_page_url": None, "pagination_selector": None}
+
+def _build_messages(content_markdown: str, html_content: str, query: str) -> List[Dict[str, str]]:
+    """
+    Builds the chat messages for company + pagination extraction.
+    Uses Markdown for content and HTML snippets for pagination.
+    If there is no usable Markdown, the cleaned HTML is used as content.
+    """
+    # Parse the page once for both steps
+    tree = _build_tree(html_content)
+    # 1. Prepare Interactive Elements (HTML for Pagination) - reads the tree as-is
+    interactive_html = extract_interactive_elements(tree)
+    # 2. Prepare Content (Markdown for Companies) - cleaning mutates the tree, so it goes last
+    if not content_markdown:
+        content_markdown = clean_content(tree)
+    
+    # Debug: Log first 500 chars of content to see what LLM is receiving
+    print(f"LLM Extractor: query '{query}', content length {len(content_markdown)} chars")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Content preview (first 500 chars):\n{content_markdown[:500]}")
+    
+    # Fit content + interactive elements into the model's context on token boundaries
+    # (the query is counted as part of the fixed prompt overhead)
+    overhead = count_prompt_tokens(SYSTEM_PROMPT, EXTRACTION_MODEL)
+    overhead += count_tokens(_USER_PROMPT_TEMPLATE.format(query=query, content="", interactive=""), EXTRACTION_MODEL)
+    budget = MAX_INPUT_TOKENS - RESPONSE_TOKEN_RESERVE - overhead
+    content, interactive = pack_texts([content_markdown, interactive_html], [CONTENT_SHARE, INTERACTIVE_SHARE], budget, EXTRACTION_MODEL)
+    
+    user_prompt = _USER_PROMPT_TEMPLATE.format(query=query, content=content, interactive=interactive)
+
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def extract_data_with_llm(content_markdown: str, html_content: str, query: str) -> Dict[str, Any]:
+    """
+    Extracts company data and next page URL/Selector using LLM.
+    Blocking version, kept for callers outside the event loop.
+    """
+    client = get_client()
+    if not client:
+        print("Warning: No OpenAI API Key. Returning empty extraction.")
+        return _empty_result()
+
+    messages = _build_messages(content_markdown, html_content, query)
+
+    key = cache_key(EXTRACTION_MODEL, messages[0]["content"], messages[1]["content"])
+    cached = get_cached(key)
+    if cached is not None:
+        print("LLM Extractor: using cached extraction")
+        return cached
+
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-16k", 
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
+        response = create_chat_completion_sync(
+            client,
+            model=EXTRACTION_MODEL,
+            messages=messages,
             temperature=0.0,
-            response_format={"type": "json_object"}
+            response_format=_RESPONSE_FORMAT
         )
         
-        result = json.loads(response.choices[0].message.content)
+        result = _drop_non_companies(orjson.loads(response.choices[0].message.content))
+        set_cached(key, result)
+        return result
+        
+    except Exception as e:
+        print(f"LLM Extraction Error: {e}")
+        return _empty_result()
+
+class _CompanyStreamParser:
+    """
+    Incremental parser for a streamed extraction answer: returns each object of
+    the "companies": [...] array as soon as its closing brace has arrived.
+    """
+
+    _ARRAY_START = re.compile(r'"companies"\s*:\s*\[')
+
+    def __init__(self):
+        self.text = ""        # Everything received so far (for the final full parse)
+        self.count = 0        # Number of companies returned so far
+        self._pos = 0         # Next character of `text` to scan
+        self._in_array = False
+        self._done = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._obj_start = None
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self.text += chunk
+        if self._done:
+            return []
+        if not self._in_array:
+            match = self._ARRAY_START.search(self.text)
+            if not match:
+                return []
+            self._in_array = True
+            self._pos = match.end()
+
+        companies = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                if self._depth == 0:
+                    self._obj_start = i
+                self._depth += 1
+            elif ch in "}]":
+                if self._depth == 0: # End of the companies array
+                    self._done = True
+                    break
+                self._depth -= 1
+                if self._depth == 0:
+                    company = orjson.loads(text[self._obj_start:i + 1])
+                    if isinstance(company, dict):
+                        companies.append(company)
+        self._pos = len(text)
+        self.count += len(companies)
+        return companies
+
+async def _put_companies(company_queue: Optional[asyncio.Queue], companies: List[Dict[str, Any]]) -> None:
+    if company_queue is not None:
+        for company in companies:
+            if _is_company(company):
+                await company_queue.put(company)
+
+async def _complete_extraction(client, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    response = await create_chat_completion(
+        client,
+        RESPONSE_TOKEN_RESERVE,
+        model=EXTRACTION_MODEL,
+        messages=messages,
+        temperature=0.0,
+        response_format=_RESPONSE_FORMAT
+    )
+    return _drop_non_companies(orjson.loads(response.choices[0].message.content))
+
+async def _stream_extraction(client, messages: List[Dict[str, str]], company_queue: asyncio.Queue) -> Dict[str, Any]:
+    """
+    Streams the answer and puts each company on the queue as soon as it is complete.
+    Falls back to a buffered request if the stream fails midway.
+    """
+    parser = _CompanyStreamParser()
+    emitted = []
+    try:
+        async with stream_chat_completion(
+            client,
+            RESPONSE_TOKEN_RESERVE,
+            model=EXTRACTION_MODEL,
+            messages=messages,
+            temperature=0.0,
+            response_format=_RESPONSE_FORMAT
+        ) as stream:
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                companies = parser.feed(chunk.choices[0].delta.content)
+                emitted.extend(companies)
+                await _put_companies(company_queue, companies)
+
+        result = orjson.loads(parser.text)
+        # Anything the incremental parser could not pick up (e.g. unexpected layout)
+        await _put_companies(company_queue, result.get("companies", [])[parser.count:])
+        return _drop_non_companies(result)
+
+    except Exception as e:
+        print(f"LLM streaming failed after {len(emitted)} companies ({e}), retrying without streaming")
+
+    result = await _complete_extraction(client, messages)
+    emitted_names = {c.get("name") for c in emitted}
+    await _put_companies(company_queue, [c for c in result.get("companies", []) if c.get("name") not in emitted_names])
+    return result
+
+async def extract_data_with_llm_async(content_markdown: str, html_content: str, query: str, company_queue: Optional[asyncio.Queue] = None) -> Dict[str, Any]:
+    """
+    Async version of extract_data_with_llm using the shared AsyncOpenAI client.
+    Calls are throttled to the account's rate limits and bounded by the shared
+    LLM semaphore, so callers can asyncio.gather() many pages at once.
+
+    If `company_queue` is given the answer is streamed: each company dict is put on
+    the queue as soon as the LLM has finished it, followed by None when extraction
+    is done. The full result (incl. pagination) is still returned.
+    """
+    try:
+        return await _extract_async(content_markdown, html_content, query, company_queue)
+    finally:
+        if company_queue is not None:
+            await company_queue.put(None)
+
+async def _extract_async(content_markdown: str, html_content: str, query: str, company_queue: Optional[asyncio.Queue]) -> Dict[str, Any]:
+    client = get_async_client()
+    if not client:
+        print("Warning: No OpenAI API Key. Returning empty extraction.")
+        return _empty_result()
+
+    # HTML parsing is CPU-bound, keep it off the event loop
+    messages = await asyncio.to_thread(_build_messages, content_markdown, html_content, query)
+
+    key = cache_key(EXTRACTION_MODEL, messages[0]["content"], messages[1]["content"])
+    cached = get_cached(key)
+    if cached is not None:
+        print("LLM Extractor: using cached extraction")
+        await _put_companies(company_queue, cached.get("companies", []))
+        return cached
+
+    try:
+        if company_queue is None:
+            result = await _complete_extraction(client, messages)
+        else:
+            result = await _stream_extraction(client, messages, company_queue)
+        set_cached(key, result)
         return result
         
     except Exception as e:
         print(f"LLM Extraction Error: {e}")
-        return {"companies": [], "next_page_url": None, "pagination_selector": None}
+        return _empty_result()
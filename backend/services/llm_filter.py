@@ -1,55 +1,32 @@
-from typing import List, Dict
+from typing import List, Dict, Any, Optional, Tuple
+import asyncio
+import logging
 import os
-import json
+import re
+from urllib.parse import urlparse
 
-# Try to import openai, but handle if it's not present (though we should probably add it to requirements)
-try:
-    from openai import OpenAI
-except ImportError:
-    OpenAI = None
+import orjson
 
-def filter_search_results(results: List[Dict[str, str]], query: str) -> List[str]:
-    """
-    Filters search results based on the query using an LLM.
-    Returns a list of URLs that are relevant.
-    """
-    if not results:
-        return []
+from services.openai_client import get_client, get_async_client, create_chat_completion, create_chat_completion_sync
+from services.llm_cache import cache_key, get_cached, set_cached
+from services.tokens import count_tokens
 
-    # If OpenAI is not available or no key, return all results (fail open)
-    # This is a placeholder. ideally we should have a free LLM or user provided key.
-    # The user mentioned "Crawl4AI with its AI capabilities", but that's for extraction.
-    # For now, let's use a dummy filter if no key, or try to use a free provider if possible.
-    # Actually, let's simply return all results if we can't filter, but print a warning.
-    
-    # Check for API Key
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not OpenAI or not api_key:
-        print("Warning: OpenAI client not available or API key missing. Skipping LLM filtering.")
-        return [r.get("url") for r in results if r.get("url")]
+logger = logging.getLogger(__name__)
 
-    client = OpenAI(api_key=api_key)
-    
-    # Prepare the prompt
-    candidates = ""
-    for i, r in enumerate(results):
-        content = r.get('content', '') or r.get('snippet', '') or r.get('description', '')
-        snippet_preview = content[:300] if content else 'No snippet available'
-        candidates += f"{i}. URL: {r.get('url', 'No URL')}\n   Title: {r.get('title', 'No title')}\n   Snippet: {snippet_preview}\n\n"
-    
-    print(f"\n=== LLM Filter Input ===")
-    print(f"Query: {query}")
-    print(f"Number of candidates: {len(results)}")
-    print(f"\nCandidates:\n{candidates}")
-    print(f"========================\n")
+# Model and snippet length trade off filter quality against input tokens; both can be tuned via env
+FILTER_MODEL = os.environ.get("LLM_FILTER_MODEL", "gpt-4o-mini")
+SNIPPET_CHARS = int(os.environ.get("LLM_FILTER_SNIPPET_CHARS", 200))
 
-    system_prompt = f"""You are a URL filter. Your job is to pick URLs that will help find companies matching the user's search intent.
+# Token cap for all candidates together
+CANDIDATES_TOKEN_BUDGET = 8000
+# Expected size of the answer (a short JSON array of indices), for rate limiting
+FILTER_RESPONSE_TOKENS = 100
 
-User is searching for: "{query}"
+# Limits for packing several queries into one request (see filter_search_results_batch_async)
+MAX_BATCH_QUERIES = 8
+BATCH_TOKEN_BUDGET = 8000
 
-YOUR TASK: Select URLs that are likely to have COMPANY LISTINGS or COMPANY INFORMATION matching the user's query.
-
-GOOD URLs (SELECT these):
+_URL_CRITERIA = """GOOD URLs (SELECT these):
 ✅ Business directories (e.g., "Nepal Business Directory", "Cosmetics Suppliers List")
 ✅ B2B platforms (e.g., "TradeIndia", "Alibaba", industry marketplaces)
 ✅ Company listing pages with multiple businesses
@@ -66,8 +43,16 @@ BAD URLs (SKIP these):
 ❌ Forums or Q&A sites (Quora, Reddit)
 ❌ Login/signup pages
 ❌ Error pages
+"""
+
+# System prompts are constant (the query goes in the user prompt) so they stay byte-identical
+# across calls and OpenAI's automatic prompt caching can apply
+SYSTEM_PROMPT = f"""You are a URL filter. Your job is to pick URLs that will help find companies matching the user's search intent.
 
-SIMPLE RULE: Will this URL help find companies that match "{query}"?
+YOUR TASK: Select URLs that are likely to have COMPANY LISTINGS or COMPANY INFORMATION matching the user's query.
+
+{_URL_CRITERIA}
+SIMPLE RULE: Will this URL help find companies that match the user's query?
 - If YES → Include it
 - If NO → Skip it
 
@@ -75,46 +60,294 @@ Return a JSON array of the indices of relevant URLs.
 Example: [0, 2, 4]
 If nothing is relevant: []"""
 
+BATCH_SYSTEM_PROMPT = f"""You are a URL filter. Your job is to pick URLs that will help find companies matching the user's search intent.
+
+You will get several BATCHES. Each batch has its own search query and its own numbered search results.
+
+YOUR TASK: For EACH batch, select URLs that are likely to have COMPANY LISTINGS or COMPANY INFORMATION matching THAT batch's query.
+
+{_URL_CRITERIA}
+SIMPLE RULE: Will this URL help find companies that match the batch's query?
+- If YES → Include it
+- If NO → Skip it
+
+Return a JSON object mapping each batch number to the array of indices of relevant URLs in that batch.
+Example: {{"0": [0, 2, 4], "1": [1]}}
+If nothing in a batch is relevant, use an empty array for it."""
+
+# Results that never lead to company listings, dropped before they reach the LLM
+_EXCLUDE_HOSTS = frozenset({"linkedin.com", "facebook.com", "twitter.com", "x.com", "instagram.com", "wikipedia.org"})
+_EXCLUDE_RE = re.compile(r"(cloudflare|access denied|404 not found|captcha|sign up|log in)", re.I)
+
+def _is_excluded(result: Dict[str, str]) -> bool:
+    host = urlparse(result.get("url") or "").hostname or ""
+    host = host.removeprefix("www.")
+    # Match subdomains too (en.wikipedia.org, m.facebook.com)
+    if any(host == h or host.endswith("." + h) for h in _EXCLUDE_HOSTS):
+        return True
+    snippet = result.get('content', '') or result.get('snippet', '') or result.get('description', '')
+    return bool(snippet and _EXCLUDE_RE.search(snippet))
+
+def _prefilter(results: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """
+    Cheap host/snippet checks so obviously irrelevant results don't cost LLM tokens.
+    """
+    survivors = [r for r in results if not _is_excluded(r)]
+    if len(survivors) < len(results):
+        print(f"Pre-filter dropped {len(results) - len(survivors)} of {len(results)} results")
+    return survivors
+
+def _all_urls(results: List[Dict[str, str]]) -> List[str]:
+    return [r.get("url") for r in results if r.get("url")]
+
+def _format_candidates(results: List[Dict[str, str]]) -> Tuple[str, int, int]:
+    """
+    Formats search results as a numbered candidate list for the LLM.
+    Returns (candidates, used_tokens, included_count).
+    """
+    # Add candidates until the token budget is used up; numbering keeps the
+    # original indices so the LLM's answer still maps back onto `results`
+    entries = []
+    used_tokens = 0
+    for i, r in enumerate(results):
+        content = r.get('content', '') or r.get('snippet', '') or r.get('description', '')
+        snippet_preview = content[:SNIPPET_CHARS] if content else 'No snippet available'
+        entry = f"{i}. URL: {r.get('url', 'No URL')}\n   Title: {r.get('title', 'No title')}\n   Snippet: {snippet_preview}\n\n"
+        entry_tokens = count_tokens(entry, FILTER_MODEL)
+        if used_tokens + entry_tokens > CANDIDATES_TOKEN_BUDGET:
+            break
+        entries.append(entry)
+        used_tokens += entry_tokens
+    return "".join(entries), used_tokens, len(entries)
+
+def _build_user_prompt(results: List[Dict[str, str]], query: str) -> str:
+    """
+    Builds the user prompt listing the candidate search results.
+    """
+    candidates, used_tokens, included = _format_candidates(results)
+    
+    print(f"\n=== LLM Filter Input ===")
+    print(f"Query: {query}")
+    print(f"Number of candidates: {included}/{len(results)} ({used_tokens} tokens)")
+    if logger.isEnabledFor(logging.DEBUG): # Skip formatting the (large) dump entirely otherwise
+        logger.debug(f"Candidates:\n{candidates}")
+    print(f"========================\n")
+
     user_prompt = f"User Query: '{query}'\n\nSearch Results:\n{candidates}\n\nWhich URLs will help find companies matching this query? Return JSON array of indices."
 
+    return user_prompt
+
+def _urls_from_indices(indices: List[Any], results: List[Dict[str, str]]) -> List[str]:
+    valid_urls = []
+    for idx in indices:
+        if isinstance(idx, int) and 0 <= idx < len(results):
+            url = results[idx].get("url")
+            if url:
+                valid_urls.append(url)
+                print(f"  ✓ Selected [{idx}]: {url}")
+    print(f"\n✅ LLM Filtered {len(results)} -> {len(valid_urls)} URLs")
+    return valid_urls
+
+def _parse_indices(content: str) -> Optional[List[Any]]:
+    """
+    Parses the LLM's JSON array of indices. Returns None if the answer is unusable.
+    """
+    content = content.strip()
+    print(f"\n=== LLM Filter Response ===")
+    print(f"Raw response: {content}")
+    print(f"============================\n")
+    
+    # Parse output
+    try:
+        indices = orjson.loads(content)
+        if isinstance(indices, list):
+            return indices
+        else:
+            print(f"❌ LLM response is not a list: {indices}")
+            return None
+    except orjson.JSONDecodeError as e:
+        print(f"❌ Failed to parse LLM response as JSON: {content}")
+        print(f"   Error: {e}")
+        return None
+
+def _prepare_request(results: List[Dict[str, str]], query: str, client) -> Tuple[Optional[List[str]], List[Dict[str, str]], str]:
+    """
+    Everything before the LLM call, shared by filter_search_results(_async).
+    Returns (urls, messages, cache_key); `urls` is set when no call is needed
+    (nothing to filter, no client, or a cached selection).
+    """
+    if not results:
+        return [], [], ""
+
+    # If OpenAI is not available or no key, return all results (fail open)
+    if not client:
+        print("Warning: OpenAI client not available or API key missing. Skipping LLM filtering.")
+        return _all_urls(results), [], ""
+
+    user_prompt = _build_user_prompt(results, query)
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt}
+    ]
+
+    key = cache_key(FILTER_MODEL, SYSTEM_PROMPT, user_prompt)
+    indices = get_cached(key)
+    if indices is not None:
+        print("LLM Filter: using cached selection")
+        return _urls_from_indices(indices, results), messages, key
+    return None, messages, key
+
+def _select_urls(content: Optional[str], results: List[Dict[str, str]], key: str) -> List[str]:
+    """
+    Everything after the LLM call: parses and caches the answer, then maps it back
+    onto `results`. `content` is None if the call failed.
+    """
+    indices = _parse_indices(content) if content is not None else None
+    if indices is None:
+        return _all_urls(results) # Fail open
+    set_cached(key, indices)
+    return _urls_from_indices(indices, results)
+
+def filter_search_results(results: List[Dict[str, str]], query: str) -> List[str]:
+    """
+    Filters search results based on the query using an LLM.
+    Returns a list of URLs that are relevant.
+    """
+    results = _prefilter(results)
+    client = get_client()
+    urls, messages, key = _prepare_request(results, query, client)
+    if urls is not None:
+        return urls
+
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # Better understanding of business/directory pages
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
+        response = create_chat_completion_sync(
+            client,
+            model=FILTER_MODEL,
+            messages=messages,
             temperature=0.0
         )
-        
-        content = response.choices[0].message.content.strip()
-        print(f"\n=== LLM Filter Response ===")
-        print(f"Raw response: {content}")
-        print(f"============================\n")
-        
-        # Parse output
-        try:
-            indices = json.loads(content)
-            if isinstance(indices, list):
-                valid_urls = []
-                for idx in indices:
-                    if isinstance(idx, int) and 0 <= idx < len(results):
-                        url = results[idx].get("url")
-                        if url:
-                            valid_urls.append(url)
-                            print(f"  ✓ Selected [{idx}]: {url}")
-                print(f"\n✅ LLM Filtered {len(results)} -> {len(valid_urls)} URLs")
-                return valid_urls
-            else:
-                print(f"❌ LLM response is not a list: {indices}")
-                return [r.get("url") for r in results if r.get("url")] # Fail open
-        except json.JSONDecodeError as e:
-            print(f"❌ Failed to parse LLM response as JSON: {content}")
-            print(f"   Error: {e}")
-            return [r.get("url") for r in results if r.get("url")] # Fail open
+        content = response.choices[0].message.content
+    except Exception as e:
+        print(f"Error calling LLM: {e}")
+        content = None
+    return _select_urls(content, results, key)
+
+async def filter_search_results_async(results: List[Dict[str, str]], query: str) -> List[str]:
+    """
+    Async version of filter_search_results using the shared AsyncOpenAI client.
+    """
+    results = _prefilter(results)
+    client = get_async_client()
+    urls, messages, key = _prepare_request(results, query, client)
+    if urls is not None:
+        return urls
 
+    try:
+        response = await create_chat_completion(
+            client,
+            FILTER_RESPONSE_TOKENS,
+            model=FILTER_MODEL,
+            messages=messages,
+            temperature=0.0
+        )
+        content = response.choices[0].message.content
     except Exception as e:
         print(f"Error calling LLM: {e}")
-        return [r.get("url") for r in results if r.get("url")] # Fail open
+        content = None
+    return _select_urls(content, results, key)
 
-    return [r.get("url") for r in results if r.get("url")]
+def _group_batches(batches: List[Tuple[str, List[Dict[str, str]]]]) -> List[List[Tuple[int, str, List[Dict[str, str]], str]]]:
+    """
+    Formats each (query, results) pair and groups them into requests of at most
+    MAX_BATCH_QUERIES queries / ~BATCH_TOKEN_BUDGET tokens.
+    Each group entry is (position_in_batches, query, results, candidates).
+    """
+    groups = []
+    current = []
+    current_tokens = 0
+    for pos, (query, results) in enumerate(batches):
+        if not results:
+            continue
+        candidates, used_tokens, _ = _format_candidates(results)
+        if current and (len(current) >= MAX_BATCH_QUERIES or current_tokens + used_tokens > BATCH_TOKEN_BUDGET):
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append((pos, query, results, candidates))
+        current_tokens += used_tokens
+    if current:
+        groups.append(current)
+    return groups
+
+def _build_batch_user_prompt(group: List[Tuple[int, str, List[Dict[str, str]], str]]) -> str:
+    sections = [
+        f"=== BATCH {b} ===\nQuery: {query}\nResults:\n{candidates}"
+        for b, (_, query, _, candidates) in enumerate(group)
+    ]
+    return "\n".join(sections) + "\nFor each batch, which URLs will help find companies matching its query? Return the JSON object of indices per batch."
+
+def _parse_batch_answer(content: str) -> Optional[Dict[str, Any]]:
+    """
+    Parses the LLM's {"<batch>": [indices...]} answer. Returns None if it is unusable.
+    """
+    try:
+        answer = orjson.loads(content)
+    except orjson.JSONDecodeError as e:
+        print(f"❌ Failed to parse batched LLM response as JSON: {content}")
+        print(f"   Error: {e}")
+        return None
+    return answer if isinstance(answer, dict) else None
+
+def _select_batch_urls(answer: Dict[str, Any], group: List[Tuple[int, str, List[Dict[str, str]], str]], selected: List[List[str]]) -> None:
+    """
+    Maps a batched answer back onto `selected` (fails open per query).
+    """
+    for b, (pos, query, results, _) in enumerate(group):
+        indices = answer.get(str(b))
+        if isinstance(indices, list):
+            print(f"Batch {b} ({query}):")
+            selected[pos] = _urls_from_indices(indices, results)
+        else:
+            print(f"❌ No valid answer for batch {b} ({query}), keeping all results")
+            selected[pos] = _all_urls(results) # Fail open
+
+async def filter_search_results_batch_async(batches: List[Tuple[str, List[Dict[str, str]]]]) -> List[List[str]]:
+    """
+    Filters the search results of several queries with as few LLM calls as possible.
+    Takes (query, results) pairs and returns the relevant URLs for each pair, in order.
+    Queries are packed into one request until MAX_BATCH_QUERIES or BATCH_TOKEN_BUDGET
+    is hit, and the requests are sent concurrently.
+    """
+    batches = [(query, _prefilter(results)) for query, results in batches]
+    selected = [[] for _ in batches]
+    client = get_async_client()
+    if not client:
+        print("Warning: OpenAI client not available or API key missing. Skipping LLM filtering.")
+        return [_all_urls(results) for _, results in batches]
+
+    async def run_group(group):
+        user_prompt = _build_batch_user_prompt(group)
+        key = cache_key(FILTER_MODEL, BATCH_SYSTEM_PROMPT, user_prompt)
+        answer = get_cached(key)
+        if answer is None:
+            try:
+                response = await create_chat_completion(
+                    client,
+                    FILTER_RESPONSE_TOKENS * len(group),
+                    model=FILTER_MODEL,
+                    messages=[
+                        {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    temperature=0.0,
+                    response_format={"type": "json_object"}
+                )
+                answer = _parse_batch_answer(response.choices[0].message.content)
+            except Exception as e:
+                print(f"Error calling LLM: {e}")
+            if answer is not None:
+                set_cached(key, answer)
+        _select_batch_urls(answer or {}, group, selected)
+
+    await asyncio.gather(*[run_group(group) for group in _group_batches(batches)])
+    return selected
@@ -0,0 +1,172 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List
+
+import httpx
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from services.tokens import count_prompt_tokens, count_tokens
+
+try:
+    from openai import OpenAI, AsyncOpenAI, RateLimitError
+except ImportError:
+    OpenAI = None
+    AsyncOpenAI = None
+
+    class RateLimitError(Exception):
+        pass
+
+# Cap on concurrent in-flight LLM requests (shared by all services) to avoid 429s
+LLM_CONCURRENCY = 20
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+# Account rate limits (requests / tokens per minute), override to match your OpenAI tier
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", 500))
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", 200000))
+
+# SDK-level retries are disabled on both clients (max_retries=0): 429s are retried by
+# _retry_on_rate_limit below, so every attempt goes through the rate limiter once
+
+# Connection pool shared by every LLM call so keep-alive/HTTP2 connections are reused
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+HTTP_TIMEOUT = 60.0
+
+_client = None
+_async_client = None
+
+def get_client():
+    """
+    Returns the shared (blocking) OpenAI client, creating it on first use.
+    Returns None if the openai package or OPENAI_API_KEY is missing.
+    """
+    global _client
+    if _client is None:
+        api_key = os.environ.get("OPENAI_API_KEY")
+        if not OpenAI or not api_key:
+            return None
+        http_client = httpx.Client(limits=HTTP_LIMITS, http2=True, timeout=HTTP_TIMEOUT)
+        _client = OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+    return _client
+
+def get_async_client():
+    """
+    Returns the shared AsyncOpenAI client, creating it on first use.
+    Returns None if the openai package or OPENAI_API_KEY is missing.
+    """
+    global _async_client
+    if _async_client is None:
+        api_key = os.environ.get("OPENAI_API_KEY")
+        if not AsyncOpenAI or not api_key:
+            return None
+        http_client = httpx.AsyncClient(limits=HTTP_LIMITS, http2=True, timeout=HTTP_TIMEOUT)
+        _async_client = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+    return _async_client
+
+class RateLimiter:
+    """
+    Token-bucket throttle on both requests/min and tokens/min.
+    Callers wait until enough capacity has refilled instead of hitting 429s.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests_available: float = rpm
+        self.tokens_available: float = tpm
+        self.last_refill: float = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.requests_available = min(self.rpm, self.requests_available + elapsed * self.rpm / 60)
+        self.tokens_available = min(self.tpm, self.tokens_available + elapsed * self.tpm / 60)
+
+    async def acquire(self, n_tokens: int) -> None:
+        n_tokens = min(n_tokens, self.tpm) # A single oversized request must still be able to go through
+        async with self._lock: # First come, first served
+            while True:
+                self._refill()
+                if self.requests_available >= 1 and self.tokens_available >= n_tokens:
+                    self.requests_available -= 1
+                    self.tokens_available -= n_tokens
+                    return
+                wait = max(
+                    (1 - self.requests_available) * 60 / self.rpm,
+                    (n_tokens - self.tokens_available) * 60 / self.tpm,
+                )
+                await asyncio.sleep(max(wait, 0.01))
+
+rate_limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM)
+
+def estimate_request_tokens(model: str, messages: List[Dict[str, str]], response_tokens: int) -> int:
+    """
+    Prompt tokens + expected response tokens, as counted against the TPM limit.
+    """
+    total = response_tokens
+    for m in messages:
+        # System prompts repeat across calls, so their counts are cached
+        counter = count_prompt_tokens if m["role"] == "system" else count_tokens
+        total += counter(m["content"], model)
+    return total
+
+# Back off and retry when the API answers 429 despite the throttling
+_retry_on_rate_limit = retry(
+    retry=retry_if_exception_type(RateLimitError),
+    wait=wait_random_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+@_retry_on_rate_limit
+def create_chat_completion_sync(client, **kwargs) -> Any:
+    """
+    chat.completions.create on the blocking client, with the same retries on 429s.
+    (Not throttled: the rate limiter and semaphore belong to the event loop.)
+    """
+    return client.chat.completions.create(**kwargs)
+
+@_retry_on_rate_limit
+async def create_chat_completion(client, response_tokens: int, **kwargs) -> Any:
+    """
+    Throttled chat.completions.create on the async client: waits for rate-limit
+    capacity, holds a concurrency slot during the call and retries on 429s.
+    """
+    n_tokens = estimate_request_tokens(kwargs["model"], kwargs["messages"], response_tokens)
+    await rate_limiter.acquire(n_tokens)
+    async with llm_semaphore:
+        return await client.chat.completions.create(**kwargs)
+
+@_retry_on_rate_limit
+async def _open_chat_stream(client, response_tokens: int, **kwargs) -> Any:
+    """
+    Opens a stream with the same order as create_chat_completion (rate limit first,
+    then a concurrency slot). On success the slot stays acquired for the caller.
+    """
+    n_tokens = estimate_request_tokens(kwargs["model"], kwargs["messages"], response_tokens)
+    await rate_limiter.acquire(n_tokens)
+    await llm_semaphore.acquire()
+    try:
+        return await client.chat.completions.create(stream=True, **kwargs)
+    except BaseException:
+        llm_semaphore.release() # Don't hold the slot while backing off
+        raise
+
+@asynccontextmanager
+async def stream_chat_completion(client, response_tokens: int, **kwargs) -> AsyncIterator[Any]:
+    """
+    Streaming counterpart of create_chat_completion. The concurrency slot is held
+    until the caller has finished consuming the stream (the request is in flight
+    until then), and the stream is closed on exit, also on errors/cancellation.
+    """
+    stream = await _open_chat_stream(client, response_tokens, **kwargs)
+    try:
+        yield stream
+    finally:
+        try:
+            await stream.close()
+        finally:
+            llm_semaphore.release()
@@ -0,0 +1,98 @@
+import time
+from functools import lru_cache
+from typing import Dict, List
+
+# Try to import tiktoken for exact token counts; fall back to a ~4 chars/token estimate
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+class _ApproxEncoding:
+    """
+    Stand-in for a tiktoken encoding when tiktoken is not installed (or its data can't be loaded).
+    Treats every 4 characters as one token.
+    """
+    chars_per_token = 4
+
+    def encode(self, text: str, disallowed_special=()) -> List[str]:
+        step = self.chars_per_token
+        return [text[i:i + step] for i in range(0, len(text), step)]
+
+    def decode(self, tokens: List[str]) -> str:
+        return "".join(tokens)
+
+# After a failed tokenizer load, use approximate counts for this long before trying again
+ENCODING_RETRY_SECONDS = 60.0
+
+_APPROX_ENCODING = _ApproxEncoding()
+_encoding_failed_at: Dict[str, float] = {}
+
+@lru_cache(maxsize=None)
+def _load_encoding(model: str):
+    # Only successful loads are cached (lru_cache doesn't cache exceptions)
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def get_encoding(model: str):
+    """
+    Returns the tokenizer for a model (cached, loading an encoding is expensive).
+    Falls back to approximate counts while the tokenizer can't be loaded.
+    """
+    if not tiktoken:
+        return _APPROX_ENCODING
+    failed_at = _encoding_failed_at.get(model)
+    if failed_at is not None and time.monotonic() - failed_at < ENCODING_RETRY_SECONDS:
+        return _APPROX_ENCODING
+    try:
+        enc = _load_encoding(model)
+    except Exception as e:
+        # tiktoken downloads its BPE files on first use; don't fail the request if that's not possible
+        print(f"Warning: Could not load tokenizer for {model} ({e}). Using approximate token counts.")
+        _encoding_failed_at[model] = time.monotonic()
+        return _APPROX_ENCODING
+    _encoding_failed_at.pop(model, None)
+    return enc
+
+def _encode(enc, text: str) -> list:
+    # Crawled text is untrusted: "<|endoftext|>" etc. must be counted as plain text, not raise
+    return enc.encode(text, disallowed_special=())
+
+def count_tokens(text: str, model: str) -> int:
+    return len(_encode(get_encoding(model), text))
+
+@lru_cache(maxsize=32)
+def _count_prompt_tokens_exact(prompt: str, model: str) -> int:
+    return count_tokens(prompt, model)
+
+def count_prompt_tokens(prompt: str, model: str) -> int:
+    """
+    Cached token count for prompts that repeat across calls (e.g. system prompts).
+    Approximate counts are not cached, so they are replaced once the tokenizer loads.
+    """
+    if get_encoding(model) is _APPROX_ENCODING:
+        return count_tokens(prompt, model)
+    return _count_prompt_tokens_exact(prompt, model)
+
+def pack_texts(texts: List[str], shares: List[float], budget: int, model: str) -> List[str]:
+    """
+    Truncates several texts so together they fit in `budget` tokens.
+    Each text is guaranteed its share of the budget; whatever a short text
+    leaves unused is handed to the texts that need more.
+    """
+    enc = get_encoding(model)
+    encoded = [_encode(enc, t) for t in texts]
+    limits = [max(int(budget * share), 0) for share in shares]
+
+    spare = sum(max(limit - len(tokens), 0) for tokens, limit in zip(encoded, limits))
+    packed = []
+    for text, tokens, limit in zip(texts, encoded, limits):
+        if len(tokens) <= limit:
+            packed.append(text)
+            continue
+        extra = min(spare, len(tokens) - limit)
+        spare -= extra
+        packed.append(enc.decode(tokens[:limit + extra]))
+    return packed